@@ -4,71 +4,231 @@ fetch_imd_combined.py -- improved IMD extraction + open-meteo fetch.
 Writes imd.json only when content changes.
 """
 
-import os, json, time, re
+import os, json, re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from html.parser import HTMLParser
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3Error
+from urllib3.util import Retry, make_headers
+try:
+    import orjson
+except ImportError:  # stdlib json fallback
+    orjson = None
 
 OUT_FILE = "imd.json"
 LAT = float(os.environ.get("AERO_LAT", "12.9896"))
 LON = float(os.environ.get("AERO_LON", "77.6387"))
 OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
 IMD_BENGALURU_PAGE = os.environ.get("IMD_PAGE", "https://mausam.imd.gov.in/bengaluru/")
-HEADERS = {"User-Agent":"github-actions-imd-fetcher/1.0 (+https://github.com/)", "Accept":"application/json,text/html"}
+HEADERS = {"User-Agent":"github-actions-imd-fetcher/1.0 (+https://github.com/)", "Accept":"application/json,text/html",
+           # gzip/deflate, plus br when a brotli decoder is installed
+           "Accept-Encoding":make_headers(accept_encoding=True)["accept-encoding"], "Connection":"keep-alive"}
 MAX_RETRIES = 3
+MAX_RETRY_AFTER = 30  # seconds; longest server-requested wait we will honour
+MAX_RESPONSE_BYTES = int(os.environ.get("IMD_MAX_RESPONSE_BYTES", "2000000"))
+MAX_HTML_CHARS = int(os.environ.get("IMD_MAX_HTML_CHARS", "200000"))
 TIMEOUT = 20
 
-KEYWORDS = ["warning","watch","nowcast","thunderstorm","thunder","heavy rain","heavy rainfall","alert","advisory","likely","possible","isolated","severe","squall","gust"]
+_SENT_SPLIT = re.compile(r'(?<=[.?!])\s+')
+_WS = re.compile(r'\s+')
+_TOKENS = re.compile(r"[A-Za-z]+")
+
+KEYWORDS = frozenset(("warning","watch","nowcast","thunderstorm","thunder","heavy rain","heavy rainfall","alert","advisory","likely","possible","isolated","severe","squall","gust"))
+_KEYWORD_RE = re.compile("|".join(re.escape(k) for k in KEYWORDS), re.IGNORECASE)
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps_bytes(obj):
+    # canonical form: sorted keys, 2-space indent, UTF-8
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, indent=2).encode("utf-8")
 
 def now_iso():
     return datetime.now(timezone.utc).astimezone().isoformat()
 
-def fetch_with_retries(url, params=None):
-    backoff = 2
-    for attempt in range(1, MAX_RETRIES+1):
-        try:
-            r = requests.get(url, params=params, headers=HEADERS, timeout=TIMEOUT)
-            if 200 <= r.status_code < 300:
-                return r
-            # do not retry unauthorized or too-many-requests aggressively
-            if r.status_code in (401, 429):
-                raise requests.HTTPError(f"HTTP {r.status_code} for {url}")
-            if 500 <= r.status_code < 600:
-                pass
-            else:
-                r.raise_for_status()
-        except Exception as e:
-            print(f"Attempt {attempt} error: {e}")
-        if attempt < MAX_RETRIES:
-            time.sleep(backoff); backoff *= 2
-    raise SystemExit(f"Failed to fetch {url}")
-
-def fetch_open_meteo(lat, lon):
+class CappedRetry(Retry):
+    # only 503 may be retried on Retry-After alone (413/429 are not retried,
+    # as before), and the server-requested wait is clamped so one source
+    # cannot stall the hourly run
+    RETRY_AFTER_STATUS_CODES = frozenset({503})
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAX_RETRY_AFTER)
+
+def make_session():
+    # one pooled session: TLS handshakes are reused and urllib3 handles
+    # backoff (honouring a capped Retry-After) for transient server errors
+    retry = CappedRetry(total=MAX_RETRIES, backoff_factor=2, status_forcelist=[500, 502, 503, 504],
+                        allowed_methods=["GET"], respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=4)
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+SESSION = make_session()
+
+def conditional_headers(http):
+    # If-None-Match / If-Modified-Since from the validators saved with the previous payload
+    http = http or {}
+    headers = {}
+    if http.get("etag"):
+        headers["If-None-Match"] = http["etag"]
+    if http.get("last_modified"):
+        headers["If-Modified-Since"] = http["last_modified"]
+    return headers
+
+def http_validators(r):
+    return {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+
+def fetch_with_retries(url, params=None, extra_headers=None):
+    """Return (response, body bytes); the body is read with a MAX_RESPONSE_BYTES cap."""
+    try:
+        r = SESSION.get(url, params=params, headers=extra_headers, timeout=TIMEOUT, stream=True)
+        with r:
+            r.raise_for_status()
+            # refuse oversized bodies before (or while) downloading them
+            size = int(r.headers.get("Content-Length") or 0)
+            content = None if size > MAX_RESPONSE_BYTES else r.raw.read(MAX_RESPONSE_BYTES + 1, decode_content=True)
+    except (requests.RequestException, Urllib3Error, ValueError) as e:
+        # an ordinary exception (not SystemExit) so main() falls back for this source only
+        raise RuntimeError(f"Failed to fetch {url}: {e}") from e
+    if content is None or len(content) > MAX_RESPONSE_BYTES:
+        raise RuntimeError(f"Failed to fetch {url}: response too large (over {MAX_RESPONSE_BYTES} bytes)")
+    return r, content
+
+def fetch_open_meteo(lat, lon, prev=None, prev_http=None):
     params = {
         "latitude": lat, "longitude": lon,
         "hourly": "temperature_2m,precipitation,precipitation_probability,windspeed_10m",
         "daily": "sunrise,sunset",
         "timezone": "auto"
     }
-    r = fetch_with_retries(OPEN_METEO_URL, params=params)
-    return r.json()
+    r, content = fetch_with_retries(OPEN_METEO_URL, params=params, extra_headers=conditional_headers(prev_http))
+    if r.status_code == 304 and prev:
+        return prev, prev_http
+    return json_loads(content), http_validators(r)
 
-def extract_visible_paragraphs(html):
-    soup = BeautifulSoup(html, "html.parser")
-    # Remove noisy elements
-    for sel in soup(["script","style","nav","header","footer","form","noscript","iframe","aside","svg","canvas"]):
-        sel.decompose()
-    # Prefer main/article/section
-    for selector in ("main", "article", "section", "#content", ".content"):
-        el = soup.select_one(selector)
-        if el:
-            # gather paragraphs within
-            paras = [p.get_text(" ", strip=True) for p in el.find_all(["p","div","li","h2","h3"]) if p.get_text(strip=True)]
+NOISE_TAGS = frozenset(("script","style","nav","header","footer","form","noscript","iframe","aside","svg","canvas"))
+BLOCK_TAGS = frozenset(("p","div","li","h2","h3"))
+VOID_TAGS = frozenset(("area","base","br","col","embed","hr","img","input","link","meta","param","source","track","wbr"))
+# preferred content regions, in priority order (tag name, #id or .class)
+REGIONS = ("main", "article", "section", "#content", ".content")
+
+class ParagraphExtractor(HTMLParser):
+    """Single-pass collector of block texts, skipping noisy elements.
+
+    Each p/div/li/h2/h3 yields its whitespace-joined text (nested blocks
+    are included in their parents too), in document order.  The block
+    indices inside the first element matching each of REGIONS are recorded
+    so the caller can prefer the main content area.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []        # open (tag, matched regions) pairs
+        self.skip = 0          # depth of open NOISE_TAGS
+        self.blocks = []       # text fragments per block, in start-tag order
+        self.open_blocks = []  # indices into self.blocks of currently open blocks
+        self.region_blocks = {}
+        self.open_regions = []
+
+    def _match_regions(self, tag, attrs):
+        matched = []
+        for region in REGIONS:
+            if region in self.region_blocks:
+                continue
+            if (region == tag
+                    or (region[0] == "#" and attrs.get("id") == region[1:])
+                    or (region[0] == "." and region[1:] in (attrs.get("class") or "").split())):
+                matched.append(region)
+        return matched
+
+    def _pop(self):
+        tag, regions = self.stack.pop()
+        if tag in NOISE_TAGS:
+            self.skip -= 1
+        elif tag in BLOCK_TAGS:
+            self.open_blocks.pop()
+        for region in regions:
+            self.open_regions.remove(region)
+
+    def _close(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                while len(self.stack) > i:
+                    self._pop()
+                return
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        # implicit end tags for the common unclosed cases
+        if self.stack and self.stack[-1][0] == "p" and (tag in BLOCK_TAGS or tag in ("ul", "ol", "table")):
+            self._pop()
+        if tag == "li":
+            for open_tag, _ in reversed(self.stack):
+                if open_tag in ("ul", "ol"):
+                    break
+                if open_tag == "li":
+                    self._close("li")
+                    break
+        regions = ()
+        if tag in NOISE_TAGS:
+            self.skip += 1
+        elif self.skip:
+            if tag in BLOCK_TAGS:
+                # block inside a noisy element: tracked only so the stack stays balanced
+                self.open_blocks.append(None)
+        else:
+            regions = self._match_regions(tag, dict(attrs))
+            if tag in BLOCK_TAGS:
+                idx = len(self.blocks)
+                self.blocks.append([])
+                for region in self.open_regions:
+                    self.region_blocks[region].append(idx)
+                self.open_blocks.append(idx)
+            for region in regions:
+                self.region_blocks[region] = []
+                self.open_regions.append(region)
+        self.stack.append((tag, regions))
+
+    def handle_endtag(self, tag):
+        self._close(tag)
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        data = data.strip()
+        if not data:
+            return
+        for idx in self.open_blocks:
+            if idx is not None:
+                self.blocks[idx].append(data)
+
+    def paragraphs(self):
+        texts = [" ".join(parts) for parts in self.blocks]
+        for region in REGIONS:
+            paras = [texts[i] for i in self.region_blocks.get(region, ()) if texts[i]]
             if paras:
                 return paras
-    # fallback: use all paragraphs in body
-    paras = [p.get_text(" ", strip=True) for p in soup.find_all(["p","div","li","h2","h3"]) if p.get_text(strip=True)]
-    return paras
+        return [t for t in texts if t]
+
+def extract_visible_paragraphs(html):
+    parser = ParagraphExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.paragraphs()
 
 def is_nav_like(paragraph):
     # Reject if too short
@@ -79,87 +239,116 @@ def is_nav_like(paragraph):
     short_words = sum(1 for w in words if len(w) <= 3)
     if len(words) < 40 and (short_words / max(1, len(words))) > 0.55:
         return True
-    # If it's mostly single-word uppercase tokens, reject
-    tokens = re.findall(r"[A-Za-z]{1,}", paragraph)
-    if tokens and all(len(t) <= 4 for t in tokens) and len(tokens) < 30:
-        return True
-    return False
+    # If it's mostly single-word uppercase tokens, reject (stops at the first long token)
+    n = 0
+    for n, t in enumerate(_TOKENS.finditer(paragraph), 1):
+        if len(t.group()) > 4 or n >= 30:
+            return False
+    return n > 0
 
 def contains_keywords(paragraph):
-    low = paragraph.lower()
-    return any(k in low for k in KEYWORDS)
+    return _KEYWORD_RE.search(paragraph) is not None
 
 def pick_warnings(paragraphs):
     candidates = []
-    # First pass: paragraphs with keywords and that are not nav-like
+    # First pass: paragraphs with keywords and that are not nav-like (cheapest checks first)
     for p in paragraphs:
-        p = re.sub(r'\s+', ' ', p).strip()
+        p = _WS.sub(' ', p).strip()
+        if len(p) < 40 or not contains_keywords(p):
+            continue
         if is_nav_like(p):
             continue
-        if contains_keywords(p) and len(p) >= 40:
-            candidates.append(p)
+        candidates.append(p)
     # If we found candidate paragraphs, return them (dedup)
     if candidates:
-        seen = set(); out=[]
-        for c in candidates:
-            if c in seen: continue
-            seen.add(c); out.append(c)
-            if len(out) >= 8: break
-        return out
+        return list(dict.fromkeys(candidates))[:8]
     # Second pass: try sentence-level search for keywords
     text = "\n\n".join(paragraphs)
-    sentences = re.split(r'(?<=[.?!])\s+', text)
-    found=[]
+    sentences = _SENT_SPLIT.split(text)
+    found = {}  # ordered set
     for s in sentences:
         s = s.strip()
         if len(s) < 40: continue
         if contains_keywords(s):
-            cleaned = re.sub(r'\s+', ' ', s)
-            if cleaned not in found:
-                found.append(cleaned)
+            found[_WS.sub(' ', s)] = None
         if len(found) >= 8:
             break
-    return found
+    return list(found)
 
 def load_existing():
     if not os.path.exists(OUT_FILE):
         return None
     try:
-        with open(OUT_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(OUT_FILE, "rb") as f:
+            return json_loads(f.read())
     except Exception:
         return None
 
-def save_if_changed(payload):
-    existing = load_existing()
-    # compare canonical JSON strings
-    if existing is not None and json.dumps(existing, sort_keys=True, ensure_ascii=False) == json.dumps(payload, sort_keys=True, ensure_ascii=False):
+def load_existing_bytes(expected_len):
+    # only read the old file when its size matches; a size mismatch means it changed
+    try:
+        if os.path.getsize(OUT_FILE) != expected_len:
+            return None
+        with open(OUT_FILE, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def write_atomic(path, data):
+    # write to a temp file and rename over the target so readers never see a partial file
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def save_if_changed(payload, existing=None):
+    # already-parsed previous content: plain == exits on the first difference, no encoding needed
+    if existing is not None and existing == payload:
+        print("No change in imd.json — skipping write.")
+        return False
+    # encode once; the same bytes are used for the comparison and the write
+    new_bytes = json_dumps_bytes(payload)
+    if load_existing_bytes(len(new_bytes)) == new_bytes:
         print("No change in imd.json — skipping write.")
         return False
-    with open(OUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+    write_atomic(OUT_FILE, new_bytes)
     print(f"Wrote {OUT_FILE}")
     return True
 
-def fetch_imd_bengaluru():
-    r = fetch_with_retries(IMD_BENGALURU_PAGE)
-    html = r.text
+def fetch_imd_bengaluru(prev=None, prev_http=None):
+    r, content = fetch_with_retries(IMD_BENGALURU_PAGE, extra_headers=conditional_headers(prev_http))
+    if r.status_code == 304 and prev:
+        # page unchanged upstream: reuse the previously parsed fields
+        return prev, prev_http
+    # warnings sit near the top of the page; don't parse arbitrarily large markup
+    # decode like Response.text: declared charset, else lenient UTF-8 for unknown/missing labels
+    try:
+        html = str(content, r.encoding, errors="replace")
+    except (LookupError, TypeError):
+        html = str(content, errors="replace")
+    html = html[:MAX_HTML_CHARS]
     paras = extract_visible_paragraphs(html)
     warnings = pick_warnings(paras)
     # keep a trimmed extracted_text as fallback (first meaningful paragraphs joined)
     extracted = "\n\n".join(paras[:20])[:20000]
-    return {"source_url": IMD_BENGALURU_PAGE, "warnings": warnings, "extracted_text": extracted}
+    return {"source_url": IMD_BENGALURU_PAGE, "warnings": warnings, "extracted_text": extracted}, http_validators(r)
 
 def main():
     print("Fetching Open-Meteo and IMD Bengaluru page...")
-    om = {}
+    prev = load_existing() or {}
+    prev_http = prev.get("_http") or {}
+    # the two sources are independent, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut_om = ex.submit(fetch_open_meteo, LAT, LON, prev.get("open_meteo"), prev_http.get("open_meteo"))
+        fut_imd = ex.submit(fetch_imd_bengaluru, prev.get("imd_bengaluru"), prev_http.get("imd_bengaluru"))
+    om, om_http = {}, None
     try:
-        om = fetch_open_meteo(LAT, LON)
+        om, om_http = fut_om.result()
     except Exception as e:
         print("Open-Meteo fetch failed:", e)
-    imd = {}
+    imd, imd_http = {}, None
     try:
-        imd = fetch_imd_bengaluru()
+        imd, imd_http = fut_imd.result()
     except Exception as e:
         print("IMD fetch failed:", e)
         imd = {"source_url": IMD_BENGALURU_PAGE, "warnings": [], "extracted_text": ""}
@@ -168,10 +357,12 @@ def main():
         "fetched_at": now_iso(),
         "location": {"name": "Aerospace Park, Bangalore", "latitude": LAT, "longitude": LON},
         "open_meteo": om,
-        "imd_bengaluru": imd
+        "imd_bengaluru": imd,
+        # ETag/Last-Modified per source, for conditional GETs on the next run
+        "_http": {"open_meteo": om_http, "imd_bengaluru": imd_http}
     }
 
-    changed = save_if_changed(out)
+    changed = save_if_changed(out, prev or None)
     if not changed:
         print("No commit needed.")
     else: